@@ -1,5 +1,9 @@
 from pyramid.config import Configurator
+from ws_wrapper.cache import make_caches
+from ws_wrapper.timing import RequestTimer
+from ws_wrapper.logutil import configure_logging
 import logging
+import os
 
 log = logging.getLogger('ws_wrapper')
 
@@ -10,6 +14,10 @@ def main(global_config, **settings):
     log.debug("Starting ws_wrapper...")
     """ This function returns a Pyramid WSGI application.
     """
+    configure_logging(settings)
+    if 'here' in global_config:
+        # Don't depend on the working directory (which mod_wsgi does not set to the app directory).
+        settings.setdefault('timing.profile-dir', os.path.join(global_config['here'], 'profiles'))
     config = Configurator(settings=settings)
     config.add_route('home', '/')
     log.debug("Read configuration...")
@@ -34,6 +42,16 @@ def main(global_config, **settings):
 
     config.add_route('conflict:conflict-status', '/v3/conflict/conflict-status')
 
+    config.add_route('ws_wrapper:cache-stats', '/v3/ws_wrapper/cache_stats')
+    config.add_route('ws_wrapper:cache-clear', '/v3/ws_wrapper/cache_clear')
+
+    config.registry.ws_caches = make_caches(settings)
+
+    config.add_request_method(lambda request: RequestTimer(), 'timer', reify=True)
+    config.add_tween('ws_wrapper.timing.timing_tween_factory')
+    config.add_tween('ws_wrapper.logutil.access_log_tween_factory',
+                     under='ws_wrapper.timing.timing_tween_factory')
+
     config.scan()
     log.debug("Added routes.")
     return config.make_wsgi_app()
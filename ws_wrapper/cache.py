@@ -0,0 +1,119 @@
+import threading
+import time
+from collections import OrderedDict
+
+import logging
+
+log = logging.getLogger('ws_wrapper')
+
+
+def _size_of(value):
+    # Responses are cached as (body, status, headers) tuples; everything else is text.
+    if isinstance(value, tuple):
+        return len(value[0])
+    return len(value)
+
+
+class LRUCache:
+    """Thread-safe LRU cache bounded by entry count and (optionally) total bytes.
+
+    Entries older than `ttl` seconds (if given) are treated as misses.
+    Hit/miss/eviction counters are kept so that we can report a hit rate.
+    """
+
+    def __init__(self, name, max_entries=128, max_bytes=None, ttl=None):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, stamp, size = entry
+                if self.ttl is None or time.monotonic() - stamp < self.ttl:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        size = _size_of(value)
+        if self.max_entries <= 0 or (self.max_bytes is not None and size > self.max_bytes):
+            return
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, time.monotonic(), size)
+            self._bytes += size
+            while len(self._data) > self.max_entries or \
+                    (self.max_bytes is not None and self._bytes > self.max_bytes):
+                oldest = next(iter(self._data))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, _, size = self._data.pop(key)
+        self._bytes -= size
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self._data),
+                    'bytes': self._bytes,
+                    'max_entries': self.max_entries,
+                    'max_bytes': self.max_bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'hit_rate': (float(self.hits) / lookups) if lookups else 0.0}
+
+
+def _int_setting(settings, key, default):
+    value = settings.get(key, '')
+    if value == '' or value is None:
+        return default
+    return int(value)
+
+
+def make_caches(settings):
+    """Build the process-wide caches used by the conflict-status view from the app settings.
+
+    Returns None if the cache is disabled (conflict-cache.size=0).
+
+    Study trees are cached by study@tree, so an edit in phylesystem is only seen
+    once the entry expires (conflict-cache.study-tree-ttl), the caches are cleared
+    via /v3/ws_wrapper/cache_clear (if ws_wrapper.admin-endpoints is on), or a
+    request is sent with 'Cache-Control: no-cache'.
+    """
+    size = _int_setting(settings, 'conflict-cache.size', 256)
+    if size <= 0:
+        log.debug("Conflict cache: disabled")
+        return None
+    max_bytes = _int_setting(settings, 'conflict-cache.max-bytes', 64 * 1024 * 1024)
+    tree_ttl = _int_setting(settings, 'conflict-cache.study-tree-ttl', 120)
+    synth_ttl = _int_setting(settings, 'conflict-cache.synth-ttl', 300)
+    log.debug("Conflict cache: size=%s max-bytes=%s study-tree-ttl=%s synth-ttl=%s",
+              size, max_bytes, tree_ttl, synth_ttl)
+    return {
+        # study@tree -> newick, so that repeats skip the phylesystem fetch and serialization.
+        'study_tree': LRUCache('study_tree', max_entries=size, max_bytes=max_bytes, ttl=tree_ttl),
+        # hash(resolved request + synth_id) -> otc conflict-status response.
+        'conflict': LRUCache('conflict', max_entries=size, max_bytes=max_bytes),
+        # A single entry holding the current synth_id reported by otc.
+        'synth_id': LRUCache('synth_id', max_entries=1, ttl=synth_ttl),
+    }
@@ -8,7 +8,7 @@ log = logging.getLogger('ws_wrapper')
 
 class HttpResponseError(Exception):
     def __init__(self, body, code):
-        log.warn(body + "\n")
+        log.warning(body + "\n")
         e = dict()
         e["message"] = body
         self.body = json.dumps(e, indent=4) + "\n"
@@ -0,0 +1,168 @@
+import atexit
+import copy
+import itertools
+import json
+import logging
+import logging.handlers
+import queue
+
+from pyramid.settings import asbool
+
+log = logging.getLogger('ws_wrapper')
+access_log = logging.getLogger('ws_wrapper.access')
+
+# Set from the app settings by configure_logging().
+_body_max_chars = 1000
+_body_sample_rate = 1
+_body_counter = itertools.count()
+
+
+class _Body:
+    """Lazily-rendered request body for log messages.
+
+    Nothing is decoded or copied unless a handler actually formats the record,
+    and then at most `_body_max_chars` characters are rendered.
+    """
+    __slots__ = ('data', 'sampled')
+
+    def __init__(self, data, sampled):
+        self.data = data
+        self.sampled = sampled
+
+    def __str__(self):
+        data = self.data
+        if data is None:
+            return 'None'
+        unit = 'bytes' if isinstance(data, bytes) else 'chars'
+        if not self.sampled:
+            return '<{} {}, not sampled>'.format(len(data), unit)
+        if len(data) <= _body_max_chars:
+            text = data
+            suffix = ''
+        else:
+            text = data[:_body_max_chars]
+            suffix = '... <{} {} total>'.format(len(data), unit)
+        if isinstance(text, bytes):
+            text = text.decode('utf-8', 'replace')
+        return text + suffix
+
+
+def body_for_log(data, sample=True):
+    """Wrap a request body so that logging it is cheap, truncated and (optionally) sampled.
+
+    Pass sample=False where the body should always be shown (truncated), e.g. in error messages.
+    """
+    if isinstance(data, dict):
+        data = repr(data)
+    sampled = not sample or _body_sample_rate <= 1 or next(_body_counter) % _body_sample_rate == 0
+    return _Body(data, sampled)
+
+
+_IMMUTABLE_ARGS = (str, bytes, int, float, bool, type(None))
+
+
+class _NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """A QueueHandler that never blocks and leaves formatting to the listener thread."""
+
+    def __init__(self, q):
+        logging.handlers.QueueHandler.__init__(self, q)
+        self.dropped = 0
+        self._reported = 0
+
+    def prepare(self, record):
+        # The stock prepare() formats the message on the calling (request) thread.
+        # That is only needed if the arguments could change before the listener
+        # gets to them; plain immutable values can't.  A single dict argument
+        # becomes `record.args` itself, so it is mutable and formatted here.
+        args = record.args
+        if record.exc_info or isinstance(args, dict) or \
+                not all(isinstance(a, _IMMUTABLE_ARGS + (_Body,)) for a in (args or ())):
+            return logging.handlers.QueueHandler.prepare(self, record)
+        if any(isinstance(a, _Body) for a in args):
+            # Render bodies now (at most body-max-chars), so queued records don't keep
+            # whole request bodies alive while they wait for the listener.
+            record = copy.copy(record)
+            record.args = tuple(str(a) if isinstance(a, _Body) else a for a in args)
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return
+        # Once there is room again, tell the log itself that records were lost.
+        lost = self.dropped - self._reported
+        if lost:
+            warning = logging.LogRecord(log.name, logging.WARNING, __file__, 0,
+                                        'Logging queue was full: dropped %d log records', (lost,), None)
+            try:
+                self.queue.put_nowait(warning)
+            except queue.Full:
+                return
+            self._reported += lost
+
+
+_queue_handler = None
+
+
+def dropped_log_records():
+    """Number of log records dropped because the background logging queue was full."""
+    return _queue_handler.dropped if _queue_handler is not None else 0
+
+
+def _start_queue_logging(queue_size):
+    """Move the root logger's handlers behind a queue served by a background thread."""
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    if not handlers or any(isinstance(h, _NonBlockingQueueHandler) for h in handlers):
+        return None
+    global _queue_handler
+    q = queue.Queue(queue_size)
+    listener = logging.handlers.QueueListener(q, *handlers, respect_handler_level=True)
+    for h in handlers:
+        root.removeHandler(h)
+    _queue_handler = _NonBlockingQueueHandler(q)
+    root.addHandler(_queue_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    log.info('Logging through a background queue (%d handlers)', len(handlers))
+    return listener
+
+
+def configure_logging(settings):
+    """Apply the logging.* app settings.
+
+    Settings:
+      logging.queue            -- write log records from a background thread.
+      logging.queue-size       -- records buffered before new ones are dropped (default 10000).
+      logging.body-max-chars   -- truncate logged request bodies (default 1000).
+      logging.body-sample-rate -- only log one request body in N (default 1).
+    """
+    global _body_max_chars, _body_sample_rate
+    _body_max_chars = int(settings.get('logging.body-max-chars', 1000))
+    _body_sample_rate = int(settings.get('logging.body-sample-rate', 1))
+    if asbool(settings.get('logging.queue', False)):
+        return _start_queue_logging(int(settings.get('logging.queue-size', 10000)))
+    return None
+
+
+def access_log_tween_factory(handler, registry):
+    """Emits one structured (JSON) record per request to the 'ws_wrapper.access' logger."""
+
+    def access_log_tween(request):
+        # Create the timer (if it doesn't exist yet) before the handler runs, so 'ms' covers it.
+        timer = getattr(request, 'timer', None)
+        response = handler(request)
+        if access_log.isEnabledFor(logging.INFO):
+            record = {'method': request.method,
+                      'path': request.path,
+                      'status': response.status_code,
+                      'bytes_in': request.content_length or 0,
+                      'bytes_out': response.content_length,
+                      'ms': round(1000 * timer.total(), 2) if timer else None,
+                      'remote': request.client_addr}
+            access_log.info('%s', json.dumps(record))
+        return response
+
+    return access_log_tween
@@ -1,6 +1,8 @@
 import unittest
 import configparser
+import json
 import sys
+from unittest import mock
 
 from pyramid import testing
 
@@ -41,6 +43,125 @@ class ViewTests(unittest.TestCase):
     #     self.assertEqual(info['project'], 'OpenTree Web-Services Wrapper')
 
 
+class LRUCacheTests(unittest.TestCase):
+    def test_eviction_and_stats(self):
+        from ws_wrapper.cache import LRUCache
+        c = LRUCache('test', max_entries=2)
+        c.put('a', 'x')
+        c.put('b', 'y')
+        self.assertEqual(c.get('a'), 'x')
+        c.put('c', 'z')
+        self.assertIsNone(c.get('b'))
+        self.assertEqual(c.get('c'), 'z')
+        s = c.stats()
+        self.assertEqual((s['hits'], s['misses'], s['evictions']), (2, 1, 1))
+
+    def test_max_bytes(self):
+        from ws_wrapper.cache import LRUCache
+        c = LRUCache('test', max_entries=10, max_bytes=5)
+        c.put('a', 'xxx')
+        c.put('b', 'yyy')
+        self.assertIsNone(c.get('a'))
+        self.assertEqual(c.get('b'), 'yyy')
+
+
+class RequestTimerTests(unittest.TestCase):
+    def test_server_timing_sums_repeated_phases(self):
+        from ws_wrapper.timing import RequestTimer
+        t = RequestTimer()
+        t.add('phylesystem', 0.010)
+        t.add('otc', 0.002)
+        t.add('phylesystem', 0.005)
+        h = t.server_timing()
+        self.assertTrue(h.startswith('phylesystem;dur=15.00, otc;dur=2.00, total;dur='))
+
+
+class BodyForLogTests(unittest.TestCase):
+    def test_truncates_long_bodies(self):
+        from ws_wrapper.logutil import body_for_log
+        s = str(body_for_log(b'x' * 5000))
+        self.assertTrue(s.startswith('x' * 1000 + '...'))
+        self.assertIn('5000 bytes', s)
+        self.assertIn('5000 chars', str(body_for_log('x' * 5000)))
+        self.assertEqual(str(body_for_log('{}')), '{}')
+
+
+class ProfilingTests(unittest.TestCase):
+    def test_missing_trace_directory_does_not_fail_request(self):
+        import shutil
+        import tempfile
+        from ws_wrapper import main
+        from webtest import TestApp
+        d = tempfile.mkdtemp()
+        settings = get_testing_settings()
+        settings.update({'timing.profile-every': '2', 'timing.profile-slow-ms': '0.001',
+                         'timing.profile-dir': d})
+        testapp = TestApp(main({}, **settings))
+        shutil.rmtree(d)
+        testapp.get('/', status=200)
+        testapp.get('/', status=200)
+
+
+    def test_traces_are_written_and_rotated(self):
+        import os
+        import tempfile
+        from ws_wrapper import main
+        from webtest import TestApp
+        d = tempfile.mkdtemp()
+        settings = get_testing_settings()
+        settings.update({'timing.profile-every': '2', 'timing.profile-slow-ms': '0.001',
+                         'timing.profile-interval-ms': '1', 'timing.profile-dir': d,
+                         'timing.profile-keep': '3'})
+        testapp = TestApp(main({}, **settings))
+        testapp.get('/', status=200)
+        testapp.get('/', status=200)
+        self.assertEqual(sorted(os.path.splitext(n)[1] for n in os.listdir(d)), ['.prof', '.stacks'])
+        for i in range(4):
+            testapp.get('/', status=200)
+        self.assertEqual(len(os.listdir(d)), 3)
+
+
+class LogQueueTests(unittest.TestCase):
+    def test_dropped_records_are_counted_and_reported(self):
+        import logging
+        import queue
+        from ws_wrapper.logutil import _NonBlockingQueueHandler
+        q = queue.Queue(2)
+        h = _NonBlockingQueueHandler(q)
+        for i in range(3):
+            h.emit(logging.makeLogRecord({'msg': 'record %d', 'args': (i,)}))
+        self.assertEqual(h.dropped, 1)
+        q.get_nowait()
+        q.get_nowait()
+        h.emit(logging.makeLogRecord({'msg': 'record %d', 'args': (3,)}))
+        self.assertEqual(q.get_nowait().getMessage(), 'record 3')
+        self.assertEqual(q.get_nowait().getMessage(), 'Logging queue was full: dropped 1 log records')
+
+
+    def test_queued_record_does_not_keep_body(self):
+        import logging
+        import queue
+        from ws_wrapper.logutil import _NonBlockingQueueHandler, _Body, body_for_log
+        q = queue.Queue()
+        h = _NonBlockingQueueHandler(q)
+        body = 'x' * 100000
+        h.emit(logging.LogRecord('ws_wrapper', logging.DEBUG, __file__, 0, 'data=%s', (body_for_log(body),), None))
+        r = q.get_nowait()
+        self.assertFalse(any(isinstance(a, _Body) or a is body for a in r.args))
+        self.assertLess(len(r.getMessage()), 2000)
+
+    def test_dict_argument_is_formatted_before_queuing(self):
+        import logging
+        import queue
+        from ws_wrapper.logutil import _NonBlockingQueueHandler
+        q = queue.Queue()
+        h = _NonBlockingQueueHandler(q)
+        d = {'a': 1}
+        h.emit(logging.LogRecord('ws_wrapper', logging.DEBUG, __file__, 0, 'd=%s', (d,), None))
+        d['b'] = 2
+        self.assertEqual(q.get_nowait().getMessage(), "d={'a': 1}")
+
+
 class FunctionalTests(unittest.TestCase):
     def setUp(self):
         from ws_wrapper import main
@@ -51,5 +172,81 @@ class FunctionalTests(unittest.TestCase):
     def test_root(self):
         res = self.testapp.get('/', status=200)
 
+    def test_malformed_body_error_is_truncated(self):
+        res = self.testapp.post('/v3/conflict/conflict-status', 'x' * 100000, status=400)
+        self.assertLess(len(res.body), 2000)
+
+
+class ConflictCacheTests(unittest.TestCase):
+    def setUp(self):
+        from ws_wrapper import main
+        app = main({}, **get_testing_settings())
+        from webtest import TestApp
+        self.testapp = TestApp(app)
+        self.caches = app.registry.ws_caches
+        self.synth_id = 'opentree13.4'
+        self.calls = []
+
+    def fake_http_request(self, method, url, data=None, headers={}):
+        from pyramid.response import Response
+        self.calls.append(url)
+        if '/study/' in url:
+            return Response(json.dumps({'data': {}}))
+        if url.endswith('/tree_of_life/about'):
+            return Response(json.dumps({'synth_id': self.synth_id}))
+        return Response(json.dumps({'conflict': 'result'}))
 
+    def count(self, suffix):
+        return len([u for u in self.calls if u.endswith(suffix)])
+
+    def get_conflict(self, headers=None, testapp=None):
+        testapp = testapp or self.testapp
+        with mock.patch('ws_wrapper.views._http_request_or_excep', self.fake_http_request), \
+                mock.patch('ws_wrapper.views.get_newick_tree_from_study', return_value='(a,b);'):
+            res = testapp.get('/v3/conflict/conflict-status',
+                                   {'tree1': 'pg_1@tree1', 'tree2': 'synth'},
+                                   headers=headers, status=200)
+        self.assertEqual(json.loads(res.body), {'conflict': 'result'})
+        return res
+
+    def test_repeat_skips_phylesystem_and_otc(self):
+        self.get_conflict()
+        self.get_conflict()
+        self.assertEqual(self.count('/study/pg_1'), 1)
+        self.assertEqual(self.count('/conflict/conflict-status'), 1)
+
+    def test_new_synth_id_misses(self):
+        self.get_conflict()
+        self.caches['synth_id'].clear()
+        self.synth_id = 'opentree14.0'
+        self.get_conflict()
+        self.assertEqual(self.count('/tree_of_life/about'), 2)
+        self.assertEqual(self.count('/study/pg_1'), 1)
+        self.assertEqual(self.count('/conflict/conflict-status'), 2)
+
+    def test_admin_endpoints_are_off_by_default(self):
+        self.testapp.get('/v3/ws_wrapper/cache_stats', status=404)
+        self.testapp.post('/v3/ws_wrapper/cache_clear', status=404)
+        from ws_wrapper import main
+        from webtest import TestApp
+        settings = get_testing_settings()
+        settings['ws_wrapper.admin-endpoints'] = 'true'
+        testapp = TestApp(main({}, **settings))
+        self.assertIn('conflict', testapp.get('/v3/ws_wrapper/cache_stats', status=200).json)
+        testapp.post('/v3/ws_wrapper/cache_clear', status=200)
+
+    def test_server_timing_lists_phases(self):
+        from ws_wrapper import main
+        from webtest import TestApp
+        self.assertNotIn('Server-Timing', self.get_conflict().headers)
+        settings = get_testing_settings()
+        settings['timing.server-timing'] = 'true'
+        res = self.get_conflict(testapp=TestApp(main({}, **settings)))
+        phases = [p.split(';')[0] for p in res.headers['Server-Timing'].split(', ')]
+        self.assertEqual(phases, ['settings', 'phylesystem', 'phylesystem-json', 'newick',
+                                  'otc-about', 'otc', 'total'])
 
+    def test_no_cache_refetches_study_tree(self):
+        self.get_conflict()
+        self.get_conflict(headers={'Cache-Control': 'no-cache'})
+        self.assertEqual(self.count('/study/pg_1'), 2)
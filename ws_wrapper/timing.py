@@ -0,0 +1,217 @@
+import cProfile
+import itertools
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from pyramid.settings import asbool
+
+import logging
+
+log = logging.getLogger('ws_wrapper')
+
+
+class RequestTimer:
+    """Accumulates wall-clock time spent in named phases of a single request."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - t0)
+
+    def add(self, name, seconds):
+        self.phases.append((name, seconds))
+
+    def total(self):
+        return time.perf_counter() - self.start
+
+    def server_timing(self):
+        # Phases can repeat (e.g. two study trees): sum them, keeping first-seen order.
+        durations = {}
+        for name, seconds in self.phases:
+            durations[name] = durations.get(name, 0.0) + seconds
+        parts = ['{};dur={:.2f}'.format(name, 1000 * seconds) for name, seconds in durations.items()]
+        parts.append('total;dur={:.2f}'.format(1000 * self.total()))
+        return ', '.join(parts)
+
+
+@contextmanager
+def timed(request, name):
+    """Time a block as phase `name` of `request`, if the request has a timer."""
+    timer = getattr(request, 'timer', None)
+    if timer is None:
+        yield
+    else:
+        with timer.phase(name):
+            yield
+
+
+class StackSampler:
+    """One background thread that periodically samples the stacks of registered threads.
+
+    Much cheaper than cProfile, so it can run on every request when we only
+    want to keep traces for requests that turn out to be slow.  A single
+    sampler serves all requests: each tick takes one snapshot of the
+    process's frames and records the stacks of the threads currently
+    registered.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._stacks = {}
+        self._lock = threading.Condition()
+        self._thread = None
+
+    def register(self, thread_id):
+        """Start collecting samples for `thread_id`."""
+        with self._lock:
+            self._stacks[thread_id] = Counter()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='ws_wrapper-sampler', daemon=True)
+                self._thread.start()
+            self._lock.notify()
+
+    def unregister(self, thread_id):
+        """Stop sampling `thread_id` and return its collected stacks."""
+        with self._lock:
+            return self._stacks.pop(thread_id, Counter())
+
+    def _run(self):
+        while True:
+            with self._lock:
+                # Sleep until there is something to sample.
+                while not self._stacks:
+                    self._lock.wait()
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, stacks in self._stacks.items():
+                    frame = frames.get(thread_id)
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append('{}:{}:{}'.format(os.path.basename(code.co_filename), code.co_name,
+                                                       frame.f_lineno))
+                        frame = frame.f_back
+                    if stack:
+                        stacks[';'.join(reversed(stack))] += 1
+            del frames
+
+
+def write_stacks(stacks, path):
+    # "Collapsed stack" format, as consumed by flamegraph.pl and speedscope.
+    with open(path, 'w') as f:
+        for stack, count in stacks.most_common():
+            f.write('{} {}\n'.format(stack, count))
+
+
+class TraceDirectory:
+    """A directory of profiling traces that keeps only the newest `keep` files."""
+
+    def __init__(self, path, keep):
+        self.path = path
+        self.keep = keep
+        self._lock = threading.Lock()
+        self._serial = itertools.count()
+        os.makedirs(path, exist_ok=True)
+
+    def new_path(self, request, suffix):
+        route = request.path.strip('/').replace('/', '_') or 'root'
+        name = '{}-{}-{}-{}.{}'.format(time.strftime('%Y%m%dT%H%M%S'), os.getpid(), next(self._serial),
+                                       route, suffix)
+        return os.path.join(self.path, name)
+
+    def save(self, request, suffix, write):
+        """Write a trace with `write(path)`; failures are logged, never raised into the request."""
+        try:
+            write(self.new_path(request, suffix))
+        except OSError as x:
+            log.warning('Could not write trace to %s: %s', self.path, x)
+            return
+        self.rotate()
+
+    def rotate(self):
+        with self._lock:
+            try:
+                names = [os.path.join(self.path, n) for n in os.listdir(self.path)]
+                names.sort(key=os.path.getmtime)
+                for name in names[:-self.keep] if self.keep > 0 else names:
+                    os.remove(name)
+            except OSError as x:
+                log.warning('Could not rotate trace directory %s: %s', self.path, x)
+
+
+def timing_tween_factory(handler, registry):
+    """Adds a Server-Timing header and/or sampled profiling traces, as configured.
+
+    Settings:
+      timing.server-timing  -- add a Server-Timing header to every response.
+      timing.profile-every  -- cProfile one request in N.
+      timing.profile-slow-ms -- stack-sample every request; keep the trace if it took longer.
+      timing.profile-interval-ms -- stack sampling interval (default 5).
+      timing.profile-dir    -- where traces are written (default: 'profiles' next to the .ini file).
+      timing.profile-keep   -- number of traces to keep (default 100).
+    """
+    settings = registry.settings
+    server_timing = asbool(settings.get('timing.server-timing', False))
+    profile_every = int(settings.get('timing.profile-every', 0) or 0)
+    slow_ms = float(settings.get('timing.profile-slow-ms', 0) or 0)
+    interval = float(settings.get('timing.profile-interval-ms', 5) or 5) / 1000.0
+    trace_dir = None
+    if profile_every or slow_ms:
+        path = settings.get('timing.profile-dir')
+        try:
+            if not path:
+                raise OSError('timing.profile-dir is not set')
+            trace_dir = TraceDirectory(path, int(settings.get('timing.profile-keep', 100)))
+        except OSError as x:
+            # Profiling is a diagnostic: never let it keep the app from starting.
+            log.warning('Profiling disabled: could not use trace directory: %s', x)
+            profile_every = slow_ms = 0
+        else:
+            log.info('Profiling: every=%s slow-ms=%s dir=%s', profile_every, slow_ms, trace_dir.path)
+    counter = itertools.count(1)
+    sampler = StackSampler(interval) if slow_ms else None
+
+    if not (server_timing or trace_dir):
+        return handler
+
+    def timing_tween(request):
+        timer = request.timer
+        profiler = None
+        thread_id = None
+        if profile_every and next(counter) % profile_every == 0:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Only one profiler may be active per process (Python >= 3.12); skip this sample.
+                profiler = None
+        elif slow_ms:
+            thread_id = threading.get_ident()
+            sampler.register(thread_id)
+        try:
+            response = handler(request)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                trace_dir.save(request, 'prof', profiler.dump_stats)
+            elif thread_id is not None:
+                stacks = sampler.unregister(thread_id)
+                if 1000 * timer.total() >= slow_ms:
+                    trace_dir.save(request, 'stacks', lambda path: write_stacks(stacks, path))
+        if server_timing:
+            response.headers['Server-Timing'] = timer.server_timing()
+        return response
+
+    return timing_tween
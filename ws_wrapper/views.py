@@ -1,6 +1,9 @@
 from pyramid.response import Response
+from pyramid.settings import asbool
 from pyramid.view import view_config
 from ws_wrapper.exceptions import HttpResponseError
+from ws_wrapper.timing import timed
+from ws_wrapper.logutil import body_for_log, dropped_log_records
 
 try:
     # Python 3
@@ -24,6 +27,7 @@ except ImportError:
 
 
 from peyotl.utility.str_util import is_int_type, is_str_type
+import hashlib
 import json
 import re
 
@@ -45,7 +49,7 @@ def get_newick_tree_from_study(study_nexson, tree):
 
     # Try again if there is no ingroup!
     if not newick:
-        log.debug('Attempting to get newick for tree {} but got "{}"!'.format(tree, newick))
+        log.debug('Attempting to get newick for tree %s but got "%s"!', tree, newick)
         log.debug('Retrying newick parsing without reference to an ingroup.')
         ps = PhyloSchema('newick',
                          content='subtree',
@@ -94,7 +98,8 @@ def get_json(body):
 
     j = get_json_or_none(body)
     if not j:
-        raise HttpResponseError("Could not get JSON from body {}".format(body), 400)
+        # The message is logged and echoed back, so don't copy a (possibly huge) body into it.
+        raise HttpResponseError("Could not get JSON from body {}".format(body_for_log(body, sample=False)), 400)
     return j
 
 
@@ -140,7 +145,7 @@ def _merge_ott_and_node_ids(body):
         return body
 
     node_ids = j_args.pop('node_ids', [])
-    log.debug('node_ids = "{}"'.format(node_ids))
+    log.debug('node_ids = "%s"', node_ids)
     # Handle "node_ids": null
     if node_ids is None:
         node_ids = []
@@ -170,12 +175,12 @@ def _merge_ott_and_node_ids(body):
 
 # This method needs to return a Response object (See `from pyramid.response import Response`)
 def _http_request_or_excep(method, url, data=None, headers={}):
-    log.debug('   Performing {} request: URL={}'.format(method, url))
+    log.debug('   Performing %s request: URL=%s', method, url)
     try:
         if isinstance(data, dict):
             data = json.dumps(data)
     except Exception:
-        log.warn('could not encode dict json: {}'.format(repr(data)))
+        log.warning('could not encode dict json: %s', body_for_log(data))
 
     headers['Content-Type'] = 'application/json'
     req = Request(url=url, data=encode_request_data(data), headers=headers)
@@ -205,30 +210,34 @@ class WSView:
     # noinspection PyUnresolvedReferences
     def __init__(self, request):
         self.request = request
-        settings = self.request.registry.settings
-        self.phylesystem_host = settings.get('phylesystem-api.host', 'https://api.opentreeoflife.org')
-        self.phylesystem_port = settings.get('phylesystem-api.port', '')
-        if self.phylesystem_port:
-            self.phylesystem_url_pref = '{}:{}'.format(self.phylesystem_host, self.phylesystem_port)
-        else:
-            self.phylesystem_url_pref = self.phylesystem_host
-        self.study_path_prefix = settings.get('phylesystem-api.prefix', '')
-        self.phylesystem_prefix = '{}/{}'.format(self.phylesystem_url_pref, self.study_path_prefix)
-        self.otc_host = settings.get('otc.host', 'http://localhost')
-        self.otc_port = settings.get('otc.port', '1984')
-        self.otc_path_prefix = settings.get('otc.prefix', 'v3')
-        if self.otc_port:
-            self.otc_url_pref = '{}:{}'.format(self.otc_host, self.otc_port)
-        else:
-            self.otc_url_pref = self.otc_host
-        self.otc_prefix = '{}/{}'.format(self.otc_url_pref, self.otc_path_prefix)
+        with timed(request, 'settings'):
+            settings = self.request.registry.settings
+            self.phylesystem_host = settings.get('phylesystem-api.host', 'https://api.opentreeoflife.org')
+            self.phylesystem_port = settings.get('phylesystem-api.port', '')
+            if self.phylesystem_port:
+                self.phylesystem_url_pref = '{}:{}'.format(self.phylesystem_host, self.phylesystem_port)
+            else:
+                self.phylesystem_url_pref = self.phylesystem_host
+            self.study_path_prefix = settings.get('phylesystem-api.prefix', '')
+            self.phylesystem_prefix = '{}/{}'.format(self.phylesystem_url_pref, self.study_path_prefix)
+            self.otc_host = settings.get('otc.host', 'http://localhost')
+            self.otc_port = settings.get('otc.port', '1984')
+            self.otc_path_prefix = settings.get('otc.prefix', 'v3')
+            if self.otc_port:
+                self.otc_url_pref = '{}:{}'.format(self.otc_host, self.otc_port)
+            else:
+                self.otc_url_pref = self.otc_host
+            self.otc_prefix = '{}/{}'.format(self.otc_url_pref, self.otc_path_prefix)
+            self.caches = getattr(self.request.registry, 'ws_caches', None)
+            self.admin_endpoints = asbool(settings.get('ws_wrapper.admin-endpoints', False))
 
     def _forward_post(self, fullpath, data=None, headers={}):
-        # If `data` ends up being too big, we could print just the first 1k bytes or something.
-        log.debug('Forwarding request: URL={} data={}'.format(fullpath,data))
+        # body_for_log() defers rendering `data` until a handler formats the record, and truncates it.
+        log.debug('Forwarding request: URL=%s data=%s', fullpath, body_for_log(data))
         method = self.request.method
         if method == 'OPTIONS' or method == 'POST':
-            r = _http_request_or_excep(method, fullpath, data=data, headers=headers)
+            with timed(self.request, 'otc'):
+                r = _http_request_or_excep(method, fullpath, data=data, headers=headers)
 #            log.debug('   Returning response "{}"'.format(r))
             return r
         else:
@@ -244,9 +253,10 @@ class WSView:
     def phylesystem_get(self, category, element):
         path = f"/{category}/{element}"
         url = self.phylesystem_prefix + path
-        log.debug(f"Fetching {category} from phylesystem: PATH={path}")
-        r = _http_request_or_excep("GET", url)
-        log.debug(f"Fetching {category} from phylesystem: {r.status_code}")
+        log.debug("Fetching %s from phylesystem: PATH=%s", category, path)
+        with timed(self.request, 'phylesystem'):
+            r = _http_request_or_excep("GET", url)
+        log.debug("Fetching %s from phylesystem: %s", category, r.status_code)
         if r.status_code == 404:
             raise HttpResponseError(f"Phylesystem: {category} {element} not found in {self.phylesystem_prefix}!", 500)
         elif r.status_code != 200:
@@ -255,7 +265,8 @@ class WSView:
 
     def phylesystem_get_json(self, category, element):
         r = self.phylesystem_get(category, element)
-        j = json.loads(r.body)
+        with timed(self.request, 'phylesystem-json'):
+            j = json.loads(r.body)
         if 'data' not in j.keys():
             raise HttpResponseError("Error accessing phylesystem: no 'data' element in reply!", 500)
         return j['data']
@@ -265,7 +276,43 @@ class WSView:
 
     def get_study_tree(self, study, tree):
         study_nexson = self.get_study_nexson(study)
-        return get_newick_tree_from_study(study_nexson, tree)
+        with timed(self.request, 'newick'):
+            return get_newick_tree_from_study(study_nexson, tree)
+
+    def get_study_tree_cached(self, study, tree, refresh=False):
+        if self.caches is None:
+            return self.get_study_tree(study, tree)
+        key = '{}@{}'.format(study, tree)
+        newick = None if refresh else self.caches['study_tree'].get(key)
+        if newick is None:
+            newick = self.get_study_tree(study, tree)
+            self.caches['study_tree'].put(key, newick)
+        return newick
+
+    def get_synth_id(self):
+        # The conflict result depends on which synthetic tree otc is serving, so
+        #   we ask otc (at most once per synth-ttl) and fold the answer into the cache key.
+        synth_id = self.caches['synth_id'].get('synth_id')
+        if synth_id is not None:
+            return synth_id
+        with timed(self.request, 'otc-about'):
+            r = _http_request_or_excep("POST", self.otc_prefix + "/tree_of_life/about", data="{}")
+        if r.status_code != 200:
+            return None
+        synth_id = get_json_or_none(r.body) or {}
+        synth_id = synth_id.get('synth_id')
+        if synth_id:
+            self.caches['synth_id'].put('synth_id', synth_id)
+        return synth_id
+
+    def conflict_cache_key(self, data):
+        # `data` is the serialized request (with sort_keys=True, so equal requests hash equally).
+        synth_id = self.get_synth_id()
+        if not synth_id:
+            return None
+        h = hashlib.sha1(data.encode('utf-8'))
+        h.update(synth_id.encode('utf-8'))
+        return h.hexdigest()
 
     @view_config(route_name='home')
     def home_view(self):
@@ -277,22 +324,26 @@ class WSView:
 
     @view_config(route_name='tol:node_info')
     def tol_node_info_view(self):
-        d = _merge_ott_and_node_id(self.request.body)
+        with timed(self.request, 'rewrite'):
+            d = _merge_ott_and_node_id(self.request.body)
         return self.forward_post_to_otc("/tree_of_life/node_info", data=d)
 
     @view_config(route_name='tol:mrca')
     def tol_mrca_view(self):
-        d = _merge_ott_and_node_ids(self.request.body)
+        with timed(self.request, 'rewrite'):
+            d = _merge_ott_and_node_ids(self.request.body)
         return self.forward_post_to_otc("/tree_of_life/mrca", data=d)
 
     @view_config(route_name='tol:subtree')
     def tol_subtree_view(self):
-        d = _merge_ott_and_node_id(self.request.body)
+        with timed(self.request, 'rewrite'):
+            d = _merge_ott_and_node_id(self.request.body)
         return self.forward_post_to_otc("/tree_of_life/subtree", data=d)
 
     @view_config(route_name='tol:induced_subtree')
     def tol_induced_subtree_view(self):
-        d = _merge_ott_and_node_ids(self.request.body)
+        with timed(self.request, 'rewrite'):
+            d = _merge_ott_and_node_ids(self.request.body)
         return self.forward_post_to_otc("/tree_of_life/induced_subtree", data=d)
 
     @view_config(route_name='tax:about')
@@ -346,21 +397,64 @@ class WSView:
 
             self.request.method = 'POST'
         else:
-            j = get_json(self.request.body)
+            with timed(self.request, 'rewrite'):
+                j = get_json(self.request.body)
+
+        # 'Cache-Control: no-cache' re-fetches the study trees (e.g. right after a curator edit).
+        refresh = 'no-cache' in self.request.headers.get('Cache-Control', '')
 
         if 'tree1' in j.keys():
             if not is_study_tree(j['tree1']):
                 raise HttpResponseError(f"ws_wrapper: could not split '{j['tree1']}' into study and tree", 500)
             study1, tree1 = is_study_tree(j['tree1'])
             j.pop('tree1', None)
-            j[u'tree1newick'] = self.get_study_tree(study1, tree1)
+            j[u'tree1newick'] = self.get_study_tree_cached(study1, tree1, refresh)
 
         if 'tree2' in j.keys() and is_study_tree(j['tree2']):
             study2, tree2 = is_study_tree(j['tree2'])
             j.pop('tree2', None)
-            j[u'tree2'] = self.get_study_tree(study2, tree2)
+            j[u'tree2'] = self.get_study_tree_cached(study2, tree2, refresh)
+
+        # Serialize once: the newick strings can be large, and the same text is hashed and forwarded.
+        data = json.dumps(j, sort_keys=True)
+        if self.caches is None:
+            return self.forward_post_to_otc('/conflict/conflict-status', data=data)
+
+        key = self.conflict_cache_key(data)
+        if key is not None:
+            cached = self.caches['conflict'].get(key)
+            if cached is not None:
+                body, status, headerlist = cached
+                log.debug('conflict-status: cache hit for %s', key)
+                return Response(body, status, headerlist=list(headerlist))
+
+        r = self.forward_post_to_otc('/conflict/conflict-status', data=data)
+        # Only successful results are cached: errors may be transient.
+        if key is not None and r.status_code == 200:
+            self.caches['conflict'].put(key, (r.body, r.status, tuple(r.headerlist)))
+        return r
 
-        return self.forward_post_to_otc('/conflict/conflict-status', data=json.dumps(j))
+    def require_admin_endpoints(self):
+        # The /v3/ws_wrapper/ endpoints are unauthenticated, so they are off unless explicitly enabled.
+        if not self.admin_endpoints:
+            raise HttpResponseError("Not found: {}".format(self.request.path), 404)
+
+    @view_config(route_name='ws_wrapper:cache-stats', renderer='json')
+    def cache_stats_view(self):
+        self.require_admin_endpoints()
+        stats = {'logging': {'dropped_records': dropped_log_records()}}
+        if self.caches is not None:
+            stats.update((name, cache.stats()) for name, cache in self.caches.items())
+        return stats
+
+    @view_config(route_name='ws_wrapper:cache-clear', request_method='POST', renderer='json')
+    def cache_clear_view(self):
+        self.require_admin_endpoints()
+        if self.caches is not None:
+            for cache in self.caches.values():
+                cache.clear()
+        log.info("Cleared conflict-status caches")
+        return {}
 
     @view_config(route_name='tax:additions')
     def additions_view(self):
@@ -373,7 +467,7 @@ class WSView:
         # then return success and don't do anything.
         if self.request.headers["X-GitHub-Event"] == "ping":
             repo = push["repository"]["full_name"]
-            log.info(f"v3/taxonomy/additions_hook: New webhook (ping event) from repo {repo}")
+            log.info("v3/taxonomy/additions_hook: New webhook (ping event) from repo %s", repo)
             return Response("OK")
 
         amendments = []
@@ -383,13 +477,14 @@ class WSView:
                 if m:
                     amendments.append(m.group(1))
                 else:
-                    log.debug(f"no match: {filename}")
+                    log.debug("no match: %s", filename)
             for filename in commit["removed"]:
                 pass
             for filename in commit["modified"]:
                 pass
 
-        log.debug(f"new amendment:\n {amendments[0]}")
+        log.debug("new amendment:\n %s", amendments[0])
         amendment = self.phylesystem_get_json("amendment", amendments[0])
-        log.debug(f"sending amendment:\n {amendment}")
-        return self.forward_post_to_otc('/taxonomy/process_additions', data=json.dumps(amendment))
+        amendment = json.dumps(amendment)
+        log.debug("sending amendment:\n %s", body_for_log(amendment))
+        return self.forward_post_to_otc('/taxonomy/process_additions', data=amendment)